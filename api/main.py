@@ -5,12 +5,12 @@ A simple REST API to serve as an example for the tests in this repository.
 import asyncio
 
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-from typing import Dict
 from random import random
 import os
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # Endpoints will return a dummy response up to this ID number, and raise 404 error beyond it.
 ID_LIMIT = max(0, int(os.environ.get("ID_LIMIT", "100")))
@@ -18,51 +18,50 @@ ID_LIMIT = max(0, int(os.environ.get("ID_LIMIT", "100")))
 # Use to simulate actual work being done, e.g. DB query, a delay up to this value will be randomly introduced.
 MAX_DELAY = max(0.0, float(os.environ.get("MAX_DELAY", "0")))
 
+
+class ItemResponse(BaseModel):
+    item_id: int
+
+
+# All the resources are served by the same endpoint, as they only differ by their names.
+RESOURCES = frozenset({"people", "planets", "starships"})
+
+
 # Set so that the swagger / OpenAPI doc will be more precise.
+# The response model is only documented here, responses are not validated against it as that is slow.
 EXPECTED_RESPONSES = {
+    200: {"model": ItemResponse},
     404: {"description": "Item was not found"},
     503: {"description": "Server overloaded"}
 }
 
 
-class ItemResponse(BaseModel):
-    item_id: int
-
-
-async def make_response(item_id: int) -> Dict[str, int]:
-    """Shared response function, all the test endpoints are the same except their names."""
-    if item_id > ID_LIMIT:
-        raise HTTPException(status_code=404, detail=f"Item {item_id} was not found.")
-    if MAX_DELAY:
+# The delay setting can't change while the app is running, so the response function is picked once here,
+# keeping the check for it (and the delay itself) out of the requests when no delay is configured.
+if MAX_DELAY:
+    async def make_response(item_id: int) -> ORJSONResponse:
+        """Shared response function, the same for all the resources."""
+        if item_id > ID_LIMIT:
+            raise HTTPException(status_code=404, detail=f"Item {item_id} was not found.")
         try:
             await asyncio.sleep(random() * MAX_DELAY)
         except asyncio.exceptions.CancelledError:
             raise HTTPException(status_code=503, detail="Server overloaded")
-    return {"item_id": item_id}
-
-
-@app.get(
-    "/people/{item_id}",
-    response_model=ItemResponse,
-    responses=EXPECTED_RESPONSES,
-)
-async def people(item_id: int):
-    return await make_response(item_id)
-
-
-@app.get(
-    "/planets/{item_id}",
-    response_model=ItemResponse,
-    responses=EXPECTED_RESPONSES,
-)
-async def planets(item_id: int):
-    return await make_response(item_id)
+        # Returning a response directly skips FastAPI's serialization of the return value.
+        return ORJSONResponse({"item_id": item_id})
+else:
+    async def make_response(item_id: int) -> ORJSONResponse:
+        """Shared response function, the same for all the resources."""
+        if item_id > ID_LIMIT:
+            raise HTTPException(status_code=404, detail=f"Item {item_id} was not found.")
+        return ORJSONResponse({"item_id": item_id})
 
 
 @app.get(
-    "/starships/{item_id}",
-    response_model=ItemResponse,
+    "/{resource}/{item_id}",
     responses=EXPECTED_RESPONSES,
 )
-async def starships(item_id: int):
+async def resource_endpoint(resource: str, item_id: int):
+    if resource not in RESOURCES:
+        raise HTTPException(status_code=404, detail=f"Resource {resource} was not found.")
     return await make_response(item_id)
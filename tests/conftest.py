@@ -1,17 +1,20 @@
 import os
 import signal
 import subprocess
+import tempfile
+import threading
 import time
 from subprocess import Popen, PIPE
 import socket
 from pathlib import Path
 from contextlib import contextmanager
-from typing import ContextManager, Optional
+from typing import Callable, ContextManager, Dict, Optional
 import atexit
 from rich.console import Console
 
 import requests
 from requests import Session
+from requests.adapters import HTTPAdapter
 
 import pytest
 
@@ -19,6 +22,7 @@ ROOT_DIR = Path(__file__).resolve().parent.parent
 REQUEST_TIMEOUT = 1
 ID_LIMIT = 10
 SERVER_WORKERS = 2
+TEST_CONCURRENCY = SERVER_WORKERS + 1
 
 console = Console()
 
@@ -30,8 +34,33 @@ def pytest_report_teststatus(report, config):
     return '', '', ''
 
 
+def pin_worker_processes(pid: int):
+    """Pins each worker process of the given uvicorn process to a separate CPU (where possible), so they won't migrate.
+
+    Linux only, as the processes are looked up in procfs.
+    """
+    cpus = sorted(os.sched_getaffinity(0))
+    with open(f"/proc/{pid}/task/{pid}/children") as children_file:
+        child_pids = [int(child_pid) for child_pid in children_file.read().split()]
+    # Uvicorn starts its workers with multiprocessing's "spawn" method, which also starts a resource tracker process.
+    worker_pids = []
+    for child_pid in child_pids:
+        with open(f"/proc/{child_pid}/cmdline") as cmdline_file:
+            if "multiprocessing.spawn" in cmdline_file.read():
+                worker_pids.append(child_pid)
+    for i, worker_pid in enumerate(worker_pids):
+        cpu = cpus[i % len(cpus)]
+        os.sched_setaffinity(worker_pid, {cpu})
+        console.log(f"Pinned API server worker process {worker_pid} to CPU {cpu}")
+
+
 @contextmanager
-def serve_api(**server_environmental_variables) -> ContextManager:
+def serve_api(perf_mode: bool = False, **server_environmental_variables) -> ContextManager:
+    """Runs the API server with given settings, yielding a closure to send requests to it.
+
+    With 'perf_mode' the access log is disabled and the worker processes are pinned to CPUs,
+    so that these won't affect the performance measurements.
+    """
     # Get unused port.
     with socket.socket() as a_socket:
         a_socket.bind(("", 0))
@@ -43,21 +72,29 @@ def serve_api(**server_environmental_variables) -> ContextManager:
 
     console.log(
         f"Starting API server on localhost:{port_to_use} with settings: {server_environmental_variables}"
+        f"{' in performance mode' if perf_mode else ''}"
     )
     # Start the server in a subprocess.
-    # See https://fastapi.tiangolo.com/deployment/server-workers/
+    # Uvicorn manages its worker processes by itself, so there is no need for gunicorn as a process manager,
+    # see https://www.uvicorn.org/deployment/
+    # The access log is written to a file rather than a pipe, as nothing reads the pipe until the server is stopped,
+    # and the server would block on writing to it once its buffer fills up.
+    access_log_file = tempfile.TemporaryFile(mode="w+")
     server_process = Popen(
         args=(
-            "gunicorn", "api.main:app",
-            "--worker-class", "uvicorn.workers.UvicornWorker",
-            "--bind", f"0.0.0.0:{port_to_use}",
-            "--access-logfile", "-",
-            "--access-logformat", '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s"',
-            "--timeout", "10"
+            "uvicorn", "api.main:app",
+            "--host", "0.0.0.0",
+            "--port", str(port_to_use),
+            "--workers", str(SERVER_WORKERS),
+            "--loop", "uvloop",
+            "--http", "httptools",
+            "--log-level", "info",
+            "--no-access-log" if perf_mode else "--access-log",
         ),
-        stdout=PIPE,
+        stdout=access_log_file,
         stderr=PIPE,
         text=True,
+        bufsize=1,
         cwd=ROOT_DIR,
         env=env,
     )
@@ -68,28 +105,55 @@ def serve_api(**server_environmental_variables) -> ContextManager:
 
     # Wait for the server to fully start before proceeding.
     timeout = 10
-    timeout_at = time.monotonic() + 10
-    initial_output = ""
+    timeout_at = time.monotonic() + timeout
+    # Reading the log line by line blocks, so the server is killed if it does not start in time,
+    # which closes its stderr and ends the loop below.
+    kill_timer = threading.Timer(timeout, server_process.kill)
+    kill_timer.start()
+    initial_output_lines = []
     workers_ready = 0
-    while True:
+    for line in iter(server_process.stderr.readline, ""):
+        initial_output_lines.append(line)
+        if line.endswith("Application startup complete.\n"):
+            workers_ready += 1
+            if workers_ready >= SERVER_WORKERS:
+                break
+    kill_timer.cancel()
+    initial_output = "".join(initial_output_lines)
+    if workers_ready < SERVER_WORKERS:
         if time.monotonic() > timeout_at:
             raise TimeoutError(
                 f"API server did not fully start within {timeout} seconds"
             )
-        initial_output += server_process.stderr.read(1)
-        if initial_output.endswith("Application startup complete.\n"):
-            workers_ready += 1
-        if workers_ready >= SERVER_WORKERS:
-            break
+        raise RuntimeError(f"API server exited before it fully started:\n{initial_output}")
     console.log("API server started successfully!")
+    if perf_mode and hasattr(os, "sched_setaffinity"):
+        try:
+            pin_worker_processes(server_process.pid)
+        except OSError as e:
+            console.log(f"Could not pin API server worker processes to CPUs: {e}")
 
     # Create a closure function that will be then used by test code
     requests_session = Session()
+    # The default adapter pools only 10 connections and discards any extra ones,
+    # size the pool so that each of the concurrent test threads can keep its own connection alive.
+    adapter = HTTPAdapter(pool_connections=TEST_CONCURRENCY, pool_maxsize=TEST_CONCURRENCY, pool_block=True)
+    requests_session.mount("http://", adapter)
+    requests_session.headers["Connection"] = "keep-alive"
+
+    url_cache: Dict[str, str] = {}
+
+    def url_for(path: str) -> str:
+        """Full URL of the given path on this API server instance."""
+        try:
+            return url_cache[path]
+        except KeyError:
+            return url_cache.setdefault(path, f"http://localhost:{port_to_use}/{path}")
 
     def request_function(path: str, *args, **kwargs) -> Optional[requests.Response]:
         """This closure will be passed on to the test functions to avoid repeating this over and over."""
-        nonlocal requests_session, port_to_use
-        url = f"http://localhost:{port_to_use}/{path}"
+        nonlocal requests_session
+        url = url_for(path)
         try:
             return requests_session.get(
                 *args, url=url, timeout=REQUEST_TIMEOUT, **kwargs
@@ -97,6 +161,23 @@ def serve_api(**server_environmental_variables) -> ContextManager:
         except requests.Timeout:
             return None
 
+    def make_requester(path: str) -> Callable[[], Optional[requests.Response]]:
+        """Returns a closure bound to a single path, for the load tests to call in a tight loop without arguments."""
+        url = url_for(path)
+        get = requests_session.get
+
+        def requester() -> Optional[requests.Response]:
+            try:
+                return get(url, timeout=REQUEST_TIMEOUT)
+            except requests.Timeout:
+                return None
+
+        return requester
+
+    # Exposed for load generators that do not need the flexibility of the closure.
+    request_function.url_for = url_for
+    request_function.make_requester = make_requester
+
     try:
         yield request_function
     finally:
@@ -106,36 +187,53 @@ def serve_api(**server_environmental_variables) -> ContextManager:
         # Stop the server process.
         server_process.send_signal(signal.SIGINT)
         try:
-            # Retrieve stdout / stderr from the process.
-            stdout, stderr = server_process.communicate(timeout=10)
+            # Retrieve stderr from the process.
+            _, stderr = server_process.communicate(timeout=10)
         except subprocess.TimeoutExpired:
             # If the server did not respond to SIGINT for any reason, kill it.
             server_process.kill()
-            stdout, stderr = server_process.communicate()
+            _, stderr = server_process.communicate()
         console.log("Stopped API server!")
         console.log(f"Error log from the API server instance:\n{initial_output + stderr}")
         # List its access log.
         # The exercise description mentioned saving it to a file, but as it there is no mention what to do with it,
         # I opted to just log it with the rest of the test output - but for sake of readability,
-        # it is deduplicated (preserving order).
-        access_log = '\n'.join(dict.fromkeys(stdout.splitlines()))
-        console.log(f"Unique entries from access log of API server instance:\n{access_log}")
+        # it is deduplicated (preserving order) while streaming the lines from the file.
+        with access_log_file:
+            if not perf_mode:
+                access_log_file.seek(0)
+                access_log = ''.join(dict.fromkeys(access_log_file)).rstrip('\n')
+                console.log(f"Unique entries from access log of API server instance:\n{access_log}")
 
 
-# Each test will get a new instance of the api server with scope set to "function", but this can be easily changed.
-@pytest.fixture(scope="function")
+# The endpoints are stateless, so an instance of the api server is shared by all tests using the same settings,
+# the scope can be changed to "function" to get a new instance for each test.
+@pytest.fixture(scope="session")
 def serve_api_0ms_delay():
     with serve_api(WEB_CONCURRENCY=SERVER_WORKERS, ID_LIMIT=ID_LIMIT, MAX_DELAY=0) as request_function:
         yield request_function
 
 
-@pytest.fixture(scope="function")
-def serve_api_10ms_delay():
-    with serve_api(WEB_CONCURRENCY=SERVER_WORKERS, ID_LIMIT=ID_LIMIT, MAX_DELAY=0.01) as request_function:
+# Separate instances are used for the performance tests, as these run without the access log.
+@pytest.fixture(scope="session")
+def serve_api_0ms_delay_perf_mode():
+    with serve_api(
+        perf_mode=True, WEB_CONCURRENCY=SERVER_WORKERS, ID_LIMIT=ID_LIMIT, MAX_DELAY=0
+    ) as request_function:
+        yield request_function
+
+
+@pytest.fixture(scope="session")
+def serve_api_10ms_delay_perf_mode():
+    with serve_api(
+        perf_mode=True, WEB_CONCURRENCY=SERVER_WORKERS, ID_LIMIT=ID_LIMIT, MAX_DELAY=0.01
+    ) as request_function:
         yield request_function
 
 
-@pytest.fixture(scope="function")
-def serve_api_100ms_delay():
-    with serve_api(WEB_CONCURRENCY=SERVER_WORKERS, ID_LIMIT=ID_LIMIT, MAX_DELAY=0.1) as request_function:
+@pytest.fixture(scope="session")
+def serve_api_100ms_delay_perf_mode():
+    with serve_api(
+        perf_mode=True, WEB_CONCURRENCY=SERVER_WORKERS, ID_LIMIT=ID_LIMIT, MAX_DELAY=0.1
+    ) as request_function:
         yield request_function
@@ -43,3 +43,17 @@ def test_endpoint_planets(serve_api_0ms_delay):
 
 def test_endpoint_starships(serve_api_0ms_delay):
     do_endpoint_assertions("starships", serve_api_0ms_delay)
+
+
+def test_endpoint_unknown_resource(serve_api_0ms_delay):
+    response = serve_api_0ms_delay("vehicles/0")
+    assert response.status_code == 404, (
+        f"Unexpected status code {response.status_code} "
+        f"for {response.url} (expected 404)"
+    )
+    response_json = response.json()
+    expected_response_json = {"detail": "Resource vehicles was not found."}
+    assert response_json == expected_response_json, (
+        f"Unexpected response JSON {response_json!r} "
+        f"for {response.url} (expected {expected_response_json!r})"
+    )
@@ -1,66 +1,101 @@
+import asyncio
 import time
-import statistics
-from conftest import console, SERVER_WORKERS
-from typing import Callable, List, Tuple, Iterable, Iterator
-import concurrent.futures
-from itertools import zip_longest
+from conftest import console, TEST_CONCURRENCY, REQUEST_TIMEOUT
+from typing import Callable, Sequence, Tuple
+import aiohttp
+import numpy as np
 from rich.console import Group
 
 TEST_DURATION = 60
 ENDPOINT_PATH = "people/0"
-TEST_CONCURRENCY = SERVER_WORKERS + 1
 
 SOLID_BLOCK_CHARACTER = '\u2588'
 SHADED_BLOCK_CHARACTER = '\u2591'
+PASSED_CELL = f"[green]{SOLID_BLOCK_CHARACTER}[/]"
+FAILED_CELL = f"[red]{SHADED_BLOCK_CHARACTER}[/]"
 
+# Load functions return the timings as separate sequences for each field, as they are analysed one field at a time:
+#   * monotonic times for the request starts
+#   * times in seconds it took for a response
+#   * statuses of the responses, True is success, False otherwise
+Timings = Tuple[Sequence[float], Sequence[float], Sequence[bool]]
 
-def chunker(iterable: Iterable[int], n: int) -> Iterator[Tuple[int, ...]]:
-    """Based on 'grouper' recipe from itertools."""
-    args = [iter(iterable)] * n
-    for chunk in zip_longest(*args, fillvalue=None):
-        yield tuple(i for i in chunk if i is not None)
 
-
-def sequential_load_function(send_request_fn: Callable, test_ends_at: float) -> List[Tuple[float, float, bool]]:
+def sequential_load_function(send_request_fn: Callable, test_ends_at: float) -> Timings:
     """This will just make requests one by one, until time limit.
 
-    Returns a list of tuples:
-        * monotonic time for the request start
-        * time in seconds it took for a response
-        * status of the response, True is success, False otherwise
+    Returns the timings of the requests, ordered by their start time.
     """
-    timings = []
+    start_times, durations, statuses = [], [], []
+    # Bound to local names, as these are looked up on every iteration.
+    append_start, append_duration, append_status = start_times.append, durations.append, statuses.append
+    monotonic = time.monotonic
+    send_request = send_request_fn.make_requester(ENDPOINT_PATH)
     while True:
-        now = time.monotonic()
+        now = monotonic()
         if now > test_ends_at:
             break
-        response = send_request_fn(ENDPOINT_PATH)
-        took = time.monotonic() - now
+        response = send_request()
+        append_start(now)
         if response is None or not response.ok:  # request timed out or otherwise failed
-            timings.append((now, took, False))
-        else:
-            timings.append((now, response.elapsed.total_seconds(), True))
-    return timings
+            append_duration(monotonic() - now)
+            append_status(False)
+        else:  # response time is already measured by requests, no need to check the clock again
+            append_duration(response.elapsed.total_seconds())
+            append_status(True)
+    return start_times, durations, statuses
+
 
+async def async_worker(session: aiohttp.ClientSession, url: str, test_ends_at: float) -> Timings:
+    """This will make requests one by one on the given session, until time limit.
 
-def concurrent_load_function(send_request_fn: Callable, test_ends_at: float) -> List[Tuple[float, float, bool]]:
-    """This will run 'sequential_load_function' concurrently, using multithreading.
+    Returns the timings of the requests, ordered by their start time.
+    """
+    start_times, durations, statuses = [], [], []
+    append_start, append_duration, append_status = start_times.append, durations.append, statuses.append
+    monotonic = time.monotonic
+    while True:
+        now = monotonic()
+        if now > test_ends_at:
+            break
+        try:
+            async with session.get(url) as response:
+                await response.read()
+                ok = response.ok
+        except (asyncio.TimeoutError, aiohttp.ClientError):  # request timed out or the connection failed
+            ok = False
+        append_start(now)
+        append_duration(monotonic() - now)
+        append_status(ok)
+    return start_times, durations, statuses
 
-    This is not truly parallel because of GIL, but for IO load / HTTP requests it doesn't really matter.
 
-    The 'Session' object from requests is not thread safe in all conditions (e.g. with cookies involved),
-    but it is safe enough for this simple example.
+async def async_load_function(url: str, test_ends_at: float) -> Timings:
+    """This will keep TEST_CONCURRENCY requests in flight from a single thread, until time limit.
 
-    Next steps would be to use aiohttp / asyncio and multiprocessing.
+    Each worker coroutine sends its requests one by one, reusing a keep-alive connection from the shared pool.
+
+    Returns the timings of the requests of all workers, ordered by their start time.
+    """
+    connector = aiohttp.TCPConnector(limit=TEST_CONCURRENCY, limit_per_host=TEST_CONCURRENCY, keepalive_timeout=30)
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        worker_timings = await asyncio.gather(
+            *(async_worker(session, url, test_ends_at) for _ in range(TEST_CONCURRENCY))
+        )
+    start_times, durations, statuses = (np.concatenate(field) for field in zip(*worker_timings))
+    # Timings of each worker are already ordered, stable sort makes use of these sorted runs.
+    order = np.argsort(start_times, kind="stable")
+    return start_times[order], durations[order], statuses[order]
+
+
+def concurrent_load_function(send_request_fn: Callable, test_ends_at: float) -> Timings:
+    """This will run the requests concurrently, using asyncio / aiohttp instead of the 'send_request_fn' closure.
+
+    A single event loop can keep all the requests in flight without the thread switching and GIL contention
+    of the blocking 'requests' client, so the test client is less likely to be the bottleneck.
     """
-    timings = []
-    with concurrent.futures.ThreadPoolExecutor(max_workers=TEST_CONCURRENCY) as executor:
-        futures = []
-        for _ in range(TEST_CONCURRENCY):
-            futures.append(executor.submit(sequential_load_function, send_request_fn, test_ends_at))
-        for future in futures:
-            timings.extend(future.result())
-    return sorted(timings, key=lambda i: i[0])
+    return asyncio.run(async_load_function(send_request_fn.url_for(ENDPOINT_PATH), test_ends_at))
 
 
 def do_performance_test(send_request_fn: Callable, load_fn: Callable, duration: float) -> Tuple[int, int]:
@@ -70,97 +105,102 @@ def do_performance_test(send_request_fn: Callable, load_fn: Callable, duration:
         "The test will now continuously send GET requests to "
         f"{ENDPOINT_PATH!r} for {duration} seconds..."
     )
-    timings = load_fn(send_request_fn, test_ends_at)
-    took = timings[-1][0] + timings[-1][1] - timings[0][0]
-    elapsed_times = tuple(t[1] for t in timings)
-    # failed requests have the third item set to False
-    failed_requests = sum(int(not t[2]) for t in timings)
-
-    console.log(f"Made {len(timings)} requests in {took:.02f} seconds")
+    start_times, elapsed_times, statuses = load_fn(send_request_fn, test_ends_at)
+    start_times = np.asarray(start_times, dtype=np.float64)
+    elapsed_times = np.asarray(elapsed_times, dtype=np.float64)
+    statuses = np.asarray(statuses, dtype=np.bool_)
+    took = start_times[-1] + elapsed_times[-1] - start_times[0]
+    failed_requests = int((~statuses).sum())
+
+    console.log(f"Made {len(start_times)} requests in {took:.02f} seconds")
     console.log(f"{failed_requests} requests got error responses")
-    console.log(f"Arithmetic mean of response times: {statistics.mean(elapsed_times):.05f}")
-    console.log(f"Standard deviation of response times: {statistics.stdev(elapsed_times):.05f}")
-    console.log(visualize_requests(timings))
-    return len(timings), failed_requests
+    console.log(f"Arithmetic mean of response times: {np.mean(elapsed_times):.05f}")
+    console.log(f"Standard deviation of response times: {np.std(elapsed_times, ddof=1):.05f}")
+    console.log(visualize_requests(start_times, statuses))
+    return len(start_times), failed_requests
 
 
-def visualize_requests(timings: List[Tuple[float, float, bool]], columns: int = 10) -> Group:
-    """This will produce a chart that will help to visualize the status of requests, per second."""
-    requests_per_second = {}
-    for r_time, r_duration, r_status in timings:
-        int_r_time = int(r_time)
-        try:
-            requests_per_second[int_r_time].append(int(r_status))
-        except KeyError:
-            requests_per_second[int_r_time] = [int(r_status)]
-    most_requests_in_second = max((len(v) for v in requests_per_second.values()))
-    max_requests_in_column = round(most_requests_in_second / columns)
+def visualize_requests(start_times: np.ndarray, statuses: np.ndarray, columns: int = 10) -> Group:
+    """This will produce a chart that will help to visualize the status of requests, per second.
+
+    Expects the start times and statuses of the requests, ordered by the start time.
+    """
+    # Truncated in one go, relative to the first second so that these can be used as bin indices.
+    seconds = start_times.astype(np.int64)
+    seconds -= seconds[0]
+    requests_per_second = np.bincount(seconds)
+    passed_per_second = np.bincount(seconds, weights=statuses).astype(np.int64)
+    # Timings are sorted by their start time, so requests made in each second are a contiguous slice of them.
+    second_ends = np.cumsum(requests_per_second)
+    max_requests_in_column = max(1, round(int(requests_per_second.max()) / columns))
     renderables = [f"\nThis chart is a visualization of the requests made, each row represents a second,\n"
                    f"and each cell represents up to {max_requests_in_column} requests.\n"
                    f"If a cell is solid / green, it means that more than a half of its requests passed."]
 
-    for i, requests_in_second in enumerate(requests_per_second.values()):
-        row = []
-        for chunk in chunker(requests_in_second, max_requests_in_column):
-            if sum(chunk) / len(chunk) >= 0.5:  # if there is more than half passed request in this slice
-                row.append(f"[green]{SOLID_BLOCK_CHARACTER}[/]")
-            else:
-                row.append(f"[red]{SHADED_BLOCK_CHARACTER}[/]")
-        ok = sum(requests_in_second)
-        nok = len(requests_in_second) - ok
+    # Seconds without any requests are skipped.
+    for i, second in enumerate(np.flatnonzero(requests_per_second)):
+        total = int(requests_per_second[second])
+        requests_in_second = statuses[second_ends[second] - total:second_ends[second]]
+        chunk_starts = np.arange(0, total, max_requests_in_column)
+        chunk_sizes = np.diff(chunk_starts, append=total)
+        passed_in_chunks = np.add.reduceat(requests_in_second, chunk_starts, dtype=np.int64)
+        # if there is more than half passed request in a chunk, compared in integers to avoid the division
+        row = np.where(2 * passed_in_chunks >= chunk_sizes, PASSED_CELL, FAILED_CELL)
+        ok = int(passed_per_second[second])
+        nok = total - ok
         renderables.append(f't+{i:<2} {ok:>4}:white_check_mark: {nok:>4}:cross_mark: {"".join(row)}')
     renderables.append('\n')
     return Group(*renderables)
 
 
-def test_endpoint_performance_0ms_delay_sequential(serve_api_0ms_delay):
+def test_endpoint_performance_0ms_delay_sequential(serve_api_0ms_delay_perf_mode):
     total_requests, failed_requests = do_performance_test(
-        send_request_fn=serve_api_0ms_delay,
+        send_request_fn=serve_api_0ms_delay_perf_mode,
         load_fn=sequential_load_function,
         duration=TEST_DURATION
     )
     assert failed_requests == 0, f"{failed_requests}/{total_requests} requests failed"
 
 
-def test_endpoint_performance_10ms_delay_sequential(serve_api_10ms_delay):
+def test_endpoint_performance_10ms_delay_sequential(serve_api_10ms_delay_perf_mode):
     total_requests, failed_requests = do_performance_test(
-        send_request_fn=serve_api_10ms_delay,
+        send_request_fn=serve_api_10ms_delay_perf_mode,
         load_fn=sequential_load_function,
         duration=TEST_DURATION
     )
     assert failed_requests == 0, f"{failed_requests}/{total_requests} requests failed"
 
 
-def test_endpoint_performance_100ms_delay_sequential(serve_api_100ms_delay):
+def test_endpoint_performance_100ms_delay_sequential(serve_api_100ms_delay_perf_mode):
     total_requests, failed_requests = do_performance_test(
-        send_request_fn=serve_api_100ms_delay,
+        send_request_fn=serve_api_100ms_delay_perf_mode,
         load_fn=sequential_load_function,
         duration=TEST_DURATION
     )
     assert failed_requests == 0, f"{failed_requests}/{total_requests} requests failed"
 
 
-def test_endpoint_performance_0ms_delay_concurrent(serve_api_0ms_delay):
+def test_endpoint_performance_0ms_delay_concurrent(serve_api_0ms_delay_perf_mode):
     total_requests, failed_requests = do_performance_test(
-        send_request_fn=serve_api_0ms_delay,
+        send_request_fn=serve_api_0ms_delay_perf_mode,
         load_fn=concurrent_load_function,
         duration=TEST_DURATION
     )
     assert failed_requests == 0, f"{failed_requests}/{total_requests} requests failed"
 
 
-def test_endpoint_performance_10ms_delay_concurrent(serve_api_10ms_delay):
+def test_endpoint_performance_10ms_delay_concurrent(serve_api_10ms_delay_perf_mode):
     total_requests, failed_requests = do_performance_test(
-        send_request_fn=serve_api_10ms_delay,
+        send_request_fn=serve_api_10ms_delay_perf_mode,
         load_fn=concurrent_load_function,
         duration=TEST_DURATION
     )
     assert failed_requests == 0, f"{failed_requests}/{total_requests} requests failed"
 
 
-def test_endpoint_performance_100ms_delay_concurrent(serve_api_100ms_delay):
+def test_endpoint_performance_100ms_delay_concurrent(serve_api_100ms_delay_perf_mode):
     total_requests, failed_requests = do_performance_test(
-        send_request_fn=serve_api_100ms_delay,
+        send_request_fn=serve_api_100ms_delay_perf_mode,
         load_fn=concurrent_load_function,
         duration=TEST_DURATION
     )